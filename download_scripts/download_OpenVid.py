@@ -1,288 +1,1125 @@
 import os
 import subprocess
 import argparse
-import glob
-import multiprocessing as mp
 from functools import partial
 import shutil
+import queue
+import threading
+import asyncio
+import signal
+import re
+import tempfile
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import zipfile
+import json
+from fractions import Fraction
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
 
 S3_BUCKET = "PLACEHOLDER"
+S3_PREFIX = "kelkar/dataset"
+# Multipart upload part size, and how many parts may be buffered and uploading at once (~1 GB of RAM)
+S3_PART_SIZE = 64 * 1024 * 1024
+S3_MAX_IN_FLIGHT_PARTS = 16
+# Read size when copying videos into an archive, zipfile's own copy uses 8 KB reads
+COPY_BUFFER_SIZE = 1024 * 1024
+HF_URL = "https://huggingface.co/datasets/nkp37/OpenVid-1M/resolve/main"
+PARTS = range(1, 100)
+# Parts that may wait between two pipeline stages
+QUEUE_SIZE = 2
+# HD zips (~45 GB each) allowed on disk at once across all stages: the part being
+# encoded plus one downloading ahead of it. A part's slot is freed once its zip is unlinked
+MAX_PARTS_ON_DISK = 2
+
+# Kernel limits raised by --tune_network, the defaults cap TCP windows far below a 10+ Gbps link
+NETWORK_SYSCTLS = {
+    "net.core.rmem_max": "536870912",
+    "net.core.wmem_max": "536870912",
+    "net.ipv4.tcp_rmem": "4096 87380 536870912",
+    "net.ipv4.tcp_wmem": "4096 65536 536870912",
+    "net.core.netdev_max_backlog": "250000",
+}
+NIC_RING_SIZE = "4096"
+# Receive buffer aria2c requests for each connection, capped by net.core.rmem_max
+ARIA2_SOCKET_RECV_BUFFER = "16M"
+
+# GPU encoders in order of preference, libx264 is used when none of them work
+HW_ENCODERS = ["h264_nvenc", "h264_vaapi", "h264_amf"]
+_ENCODER = None
+# Render node used for VAAPI (AMD/Intel on Linux) decode, scale and encode
+VAAPI_DEVICE = "/dev/dri/renderD128"
+
+# Videos are scaled to fit in a TARGET_SIZE x TARGET_SIZE box
+TARGET_SIZE = 480
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm', '.flv')
+
+# Without probe information, encode with the old fixed settings
+DEFAULT_PRESET = "medium"
+DEFAULT_CRF = 23
+# Hardware encoder settings equivalent to each x264 preset
+NVENC_PRESETS = {"ultrafast": "p1", "superfast": "p4", "medium": "p4", "fast": "p7"}
+AMF_QUALITY = {"ultrafast": "speed", "superfast": "balanced", "medium": "balanced", "fast": "quality"}
+
+# Only print errors and no progress, so there is little stderr to read back from each ffmpeg
+FFMPEG = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostats"]
+# ffmpeg muxer for each output extension, outputs are written to a temporary name
+# so the muxer can't always be guessed from it
+MUXERS = {".mp4": "mp4", ".m4v": "mp4", ".mov": "mov", ".mkv": "matroska", ".webm": "webm", ".avi": "avi", ".flv": "flv"}
+
+# Default number of threads each libx264 ffmpeg gets when num_processes isn't given
+FFMPEG_THREADS_PER_WORKER = 4
+# Concurrent hardware encode sessions to run per GPU
+SESSIONS_PER_GPU = 2
+
 
+def _encoder_works(encoder, work_dir):
+    """
+    Check that an encoder actually works: encode a short synthetic clip with it, then resize
+    that clip with the exact command videos get, so the hardware decoder and scale filter
+    (e.g. scale_cuda, which many ffmpeg builds lack) are tested along with the encoder
+    """
+    sample_path = os.path.join(work_dir, f"{encoder}_sample.mp4")
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error"]
+    if encoder == "h264_vaapi":
+        # VAAPI only encodes frames that are already on the device
+        command += ["-vaapi_device", VAAPI_DEVICE]
+    # Larger than TARGET_SIZE so the resize command really scales it
+    command += ["-f", "lavfi", "-i", "color=size=640x360:duration=0.2"]
+    if encoder == "h264_vaapi":
+        command += ["-vf", "format=nv12,hwupload"]
+    command += ["-c:v", encoder, "-y", sample_path]
+    resize_command = build_resize_command(
+        sample_path, os.path.join(work_dir, f"{encoder}_480p.mp4"), encoder, output_format="mp4"
+    )
+    try:
+        subprocess.run(command, check=True, capture_output=True)
+        subprocess.run(resize_command, check=True, capture_output=True)
+        return True
+    except (OSError, subprocess.CalledProcessError):
+        return False
 
-def resize_video(input_path, output_path):
+
+def detect_encoder():
     """
-    Resize video to 480p on the short side while maintaining aspect ratio
+    Detect the fastest available H.264 encoder, preferring NVENC, then VAAPI, then AMF, then libx264.
+    The result is cached so ffmpeg is only probed once per process.
+    """
+    global _ENCODER
+    if _ENCODER is not None:
+        return _ENCODER
+
+    _ENCODER = "libx264"
+    try:
+        result = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], check=True, capture_output=True, text=True)
+        # ffmpeg builds often list GPU encoders even without a GPU, so test each one
+        with tempfile.TemporaryDirectory() as work_dir:
+            for encoder in HW_ENCODERS:
+                if encoder not in result.stdout:
+                    continue
+                if _encoder_works(encoder, work_dir):
+                    _ENCODER = encoder
+                    break
+                print(f"Warning: {encoder} can't decode, scale and encode a test clip, not using it")
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Warning: Could not probe ffmpeg encoders, using libx264: {e}")
+
+    print(f"Using video encoder: {_ENCODER}")
+    return _ENCODER
+
+
+def count_gpus(encoder):
+    """
+    Count the GPUs available to the given hardware encoder (at least 1)
+    """
+    if encoder == "h264_nvenc":
+        try:
+            result = subprocess.run(["nvidia-smi", "-L"], check=True, capture_output=True, text=True)
+            return max(1, len([line for line in result.stdout.splitlines() if line.startswith("GPU")]))
+        except (OSError, subprocess.CalledProcessError):
+            pass
+    # Every VAAPI command uses VAAPI_DEVICE, so only one GPU is used there
+    return 1
+
+
+def plan_workers(num_videos, encoder, num_processes=None):
+    """
+    Decide how many videos to encode in parallel and how many threads each ffmpeg gets,
+    so that processes x threads matches the CPU instead of oversubscribing it.
+    Returns (num_processes, ffmpeg_threads) tuple
+    """
+    cpu_count = os.cpu_count() or 1
+    if encoder != "libx264":
+        # The CPU only demuxes/muxes on the GPU path, and hardware encode sessions are limited
+        max_processes = SESSIONS_PER_GPU * count_gpus(encoder)
+        if num_processes is not None:
+            max_processes = num_processes
+        ffmpeg_threads = 1
+    else:
+        if num_processes is None:
+            ffmpeg_threads = min(cpu_count, FFMPEG_THREADS_PER_WORKER)
+        else:
+            ffmpeg_threads = max(2, cpu_count // num_processes)
+        max_processes = cpu_count // ffmpeg_threads
+
+    return max(1, min(num_videos, max_processes)), ffmpeg_threads
+
+
+def unzip_pattern(member):
+    """
+    Escape a zip member name for unzip, which treats its member arguments as wildcard patterns
+    """
+    return re.sub(r"([\\\[\]*?])", r"\\\1", member)
+
+
+async def run_command(command, zip_source=None, capture_stdout=False):
+    """
+    Run a command as an asyncio subprocess, feeding it a zip member on stdin when zip_source
+    is a (zip_path, member) tuple. The command should then read its input from pipe:0.
+    Returns stdout if capture_stdout, raises CalledProcessError with stderr on failure
+    """
+    stdout = asyncio.subprocess.PIPE if capture_stdout else asyncio.subprocess.DEVNULL
+    unzip = None
+    if zip_source is None:
+        # Keep ffmpeg from reading the terminal for interactive commands
+        process = await asyncio.create_subprocess_exec(
+            *command, stdin=asyncio.subprocess.DEVNULL, stdout=stdout, stderr=asyncio.subprocess.PIPE
+        )
+    else:
+        zip_path, member = zip_source
+        read_fd, write_fd = os.pipe()
+        try:
+            unzip = await asyncio.create_subprocess_exec("unzip", "-p", zip_path, unzip_pattern(member), stdout=write_fd)
+            process = await asyncio.create_subprocess_exec(
+                *command, stdin=read_fd, stdout=stdout, stderr=asyncio.subprocess.PIPE
+            )
+        finally:
+            # Only the children hold the pipe now, so unzip exits on SIGPIPE if the reader stops early
+            os.close(read_fd)
+            os.close(write_fd)
+
+    output, errors = await process.communicate()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, output, errors)
+    if unzip is not None:
+        # SIGPIPE only means the reader had what it needed (e.g. ffprobe), anything else
+        # means the command saw a truncated or unreadable member
+        await unzip.wait()
+        if unzip.returncode not in (0, -signal.SIGPIPE):
+            raise subprocess.CalledProcessError(unzip.returncode, ["unzip", "-p", zip_path, member])
+    return output
+
+
+def ffmpeg_prefix(input_path):
+    """
+    Start of every ffmpeg command. Input read from a pipe also gets -xerror: ffmpeg
+    otherwise stops at a broken stream and still exits 0 with a truncated output
+    """
+    if input_path == "pipe:0":
+        return [*FFMPEG, "-xerror"]
+    return FFMPEG
+
+
+def ffmpeg_output(output_path, output_format=None):
+    """
+    End of every ffmpeg command: force the muxer when given, then overwrite the output
+    """
+    if output_format is None:
+        return ["-y", output_path]
+    return ["-f", output_format, "-y", output_path]
+
+
+def _parse_number(value):
+    try:
+        number = float(Fraction(value))
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    return number if number > 0 else None
+
+
+async def probe_video(path, zip_source=None):
+    """
+    Probe the first video stream.
+    Returns a dict with width, height and fps (None when unknown), or None if it can't be probed
     """
-    # Simple and reliable approach: scale with 480 as maximum dimension
-    # This ensures short side is at most 480px while maintaining aspect ratio
     command = [
-        "ffmpeg", "-i", input_path,
-        "-vf", "scale=480:480:force_original_aspect_ratio=decrease:force_divisible_by=2",
-        "-c:v", "libx264",      # Use H.264 codec for good compression
-        "-crf", "23",           # Constant Rate Factor for quality (lower = better quality)
-        "-preset", "medium",    # Encoding speed vs compression efficiency
+        "ffprobe", "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "stream=width,height,avg_frame_rate",
+        "-of", "json",
+        path
+    ]
+    try:
+        probe = json.loads(await run_command(command, zip_source, capture_stdout=True))
+        stream = probe["streams"][0]
+        return {
+            "width": int(stream["width"]),
+            "height": int(stream["height"]),
+            "fps": _parse_number(stream.get("avg_frame_rate")),
+        }
+    except (OSError, subprocess.CalledProcessError, ValueError, KeyError, IndexError) as e:
+        print(f"Warning: Could not probe {path}: {e}")
+        return None
+
+
+def pick_encode_settings(info):
+    """
+    Pick the x264 preset and crf for an input. Smaller, lower frame rate inputs tolerate
+    faster presets, and smaller inputs get a lower crf since they lose less when downscaled.
+    Returns (preset, crf) tuple
+    """
+    if info is None:
+        return DEFAULT_PRESET, DEFAULT_CRF
+
+    short_side = min(info["width"], info["height"])
+    fps = info["fps"] or 30
+    if short_side <= 720 and fps <= 30:
+        preset = "ultrafast"
+    elif short_side <= 1080 and fps <= 30:
+        preset = "superfast"
+    else:
+        preset = "fast"
+
+    if short_side <= 720:
+        crf = 20
+    elif short_side < 1440:
+        crf = 23
+    else:
+        crf = 25
+    return preset, crf
+
+
+async def remux_video(input_path, output_path, zip_source=None, output_format=None):
+    """
+    Copy the streams into a new container without re-encoding, for inputs that are already small enough
+    """
+    command = [
+        *ffmpeg_prefix(input_path), "-i", input_path,
+        "-c", "copy",           # No decode/encode, just rewrite the container
+        "-movflags", "+faststart",
+        *ffmpeg_output(output_path, output_format)
+    ]
+    try:
+        await run_command(command, zip_source)
+        return True
+    except subprocess.CalledProcessError as e:
+        print(f"Error remuxing {input_path}:")
+        print(f"Return code: {e.returncode}")
+        if e.stderr:
+            print(f"STDERR: {e.stderr.decode(errors='replace')}")
+        return False
+
+
+def build_resize_command(input_path, output_path, encoder, ffmpeg_threads=None, preset=DEFAULT_PRESET, crf=DEFAULT_CRF,
+                         output_format=None, device=0):
+    """
+    Build the ffmpeg command that resizes a video to fit in 480x480 with the given encoder.
+    preset and crf use x264 terms and are mapped to the hardware encoders' equivalents.
+    device is the index of the GPU NVENC decodes and encodes on.
+    """
+    if encoder == "h264_nvenc":
+        # Decode, scale and encode on the GPU so frames never leave device memory.
+        # scale_cuda also converts to nv12, as h264_nvenc can't take 10-bit input
+        command = [
+            *ffmpeg_prefix(input_path), "-hwaccel", "cuda", "-hwaccel_output_format", "cuda",
+            "-hwaccel_device", str(device), "-i", input_path,
+            "-vf", "scale_cuda=w=480:h=480:force_original_aspect_ratio=decrease:force_divisible_by=2:format=nv12",
+            "-c:v", "h264_nvenc",
+            "-gpu", str(device),
+            "-preset", NVENC_PRESETS[preset],
+            "-rc", "vbr",           # Variable bitrate driven by -cq
+            "-cq", str(crf),        # Constant quality level, comparable to x264 crf
+            "-b:v", "0",            # Let -cq alone control the bitrate
+        ]
+    elif encoder == "h264_vaapi":
+        # Same zero-copy decode -> scale -> encode chain as NVENC, through VAAPI
+        command = [
+            *ffmpeg_prefix(input_path), "-hwaccel", "vaapi", "-hwaccel_device", VAAPI_DEVICE, "-hwaccel_output_format", "vaapi",
+            "-i", input_path,
+            "-vf", "scale_vaapi=w=480:h=480:force_original_aspect_ratio=decrease:force_divisible_by=2:format=nv12",
+            "-c:v", "h264_vaapi",
+            "-rc_mode", "CQP",      # Constant QP rate control
+            "-qp", str(crf),
+        ]
+    elif encoder == "h264_amf":
+        # AMF (mainly Windows) gets frames scaled on the CPU, since it can't take VAAPI frames
+        command = [
+            *ffmpeg_prefix(input_path), "-i", input_path,
+            "-vf", "scale=480:480:force_original_aspect_ratio=decrease:force_divisible_by=2",
+            "-c:v", "h264_amf",
+            "-usage", "transcoding",
+            "-quality", AMF_QUALITY[preset],
+            "-rc", "cqp",           # Constant QP rate control
+            "-qp_i", str(crf),
+            "-qp_p", str(crf + 2),
+        ]
+    else:
+        # Simple and reliable approach: scale with 480 as maximum dimension
+        # This ensures short side is at most 480px while maintaining aspect ratio
+        command = [
+            *ffmpeg_prefix(input_path), "-i", input_path,
+            "-vf", "scale=480:480:force_original_aspect_ratio=decrease:force_divisible_by=2",
+            "-c:v", "libx264",      # Use H.264 codec for good compression
+            "-crf", str(crf),       # Constant Rate Factor for quality (lower = better quality)
+            "-preset", preset,      # Encoding speed vs compression efficiency
+        ]
+
+    if ffmpeg_threads is not None:
+        command += ["-threads", str(ffmpeg_threads)]
+    command += [
         "-c:a", "aac",          # Audio codec
         "-b:a", "128k",         # Audio bitrate
         "-movflags", "+faststart", # Optimize for web streaming
-        "-y",                   # Overwrite output file if it exists
-        output_path
+        *ffmpeg_output(output_path, output_format) # Overwrite output file if it exists
     ]
+    return command
+
+
+async def resize_video(input_path, output_path, encoder=None, ffmpeg_threads=None, preset=DEFAULT_PRESET, crf=DEFAULT_CRF,
+                       zip_source=None, output_format=None, fallback_threads=None, device=0):
+    """
+    Resize video to 480p on the short side while maintaining aspect ratio.
+    Uses a GPU encoder when one is available and falls back to libx264 if it fails,
+    with fallback_threads ffmpeg threads instead of the GPU path's ffmpeg_threads.
+    """
+    if encoder is None:
+        encoder = detect_encoder()
+    command = build_resize_command(input_path, output_path, encoder, ffmpeg_threads, preset, crf, output_format, device)
     
     try:
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
+        await run_command(command, zip_source)
         return True
     except subprocess.CalledProcessError as e:
         print(f"Error resizing {input_path}:")
         print(f"Command: {' '.join(command)}")
         print(f"Return code: {e.returncode}")
-        if e.stdout:
-            print(f"STDOUT: {e.stdout}")
         if e.stderr:
-            print(f"STDERR: {e.stderr}")
+            # stderr is only decoded when something went wrong
+            print(f"STDERR: {e.stderr.decode(errors='replace')}")
+        if encoder != "libx264":
+            # Some inputs can't be hardware decoded, retry them on the CPU
+            print(f"Retrying {input_path} with libx264...")
+            if fallback_threads is None:
+                _, fallback_threads = plan_workers(1, "libx264")
+            return await resize_video(input_path, output_path, "libx264", fallback_threads, preset, crf, zip_source,
+                                      output_format)
         return False
 
 
-def process_single_video(args):
+async def transcode_video(input_path, output_path, encoder, ffmpeg_threads, zip_source=None, output_format=None,
+                          fallback_threads=None, device=0):
+    """
+    Remux the video if it already fits in 480x480, otherwise resize it.
+    Returns True if successful, False otherwise
+    """
+    info = await probe_video(input_path, zip_source)
+    if info is None and zip_source is not None:
+        # Nothing readable came through the pipe (e.g. moov atom at the end of the file)
+        return False
+    if info is not None and max(info["width"], info["height"]) <= TARGET_SIZE:
+        # The scale filter would be a no-op, so skip decoding and encoding entirely
+        if await remux_video(input_path, output_path, zip_source, output_format):
+            return True
+    preset, crf = pick_encode_settings(info)
+    return await resize_video(input_path, output_path, encoder, ffmpeg_threads, preset, crf, zip_source, output_format,
+                              fallback_threads, device)
+
+
+def processed_filename(video_file):
+    """
+    Name of the 480p output for a video file or zip member
     """
-    Worker function to process a single video - designed for multiprocessing
+    name, ext = os.path.splitext(os.path.basename(video_file))
+    return f"{name}_480p{ext}"
+
+
+async def process_single_video(video, processed_folder, encoder, ffmpeg_threads, fallback_threads=None, device=0):
+    """
+    Process a single video, either a file path or a (zip_path, member) tuple streamed from the zip.
     Returns (success, video_file, output_path, filename) tuple
     """
-    video_file, processed_folder = args
+    zip_source = video if isinstance(video, tuple) else None
+    video_file = zip_source[1] if zip_source else video
     filename = os.path.basename(video_file)
-    name, ext = os.path.splitext(filename)
-    output_path = os.path.join(processed_folder, f"{name}_480p{ext}")
+    output_filename = processed_filename(video_file)
+    output_path = os.path.join(processed_folder, output_filename)
+    # Encode under a temporary name and rename it once complete, so an output cut short
+    # by a failure or a killed run never passes for a processed video on the next run
+    name, ext = os.path.splitext(output_filename)
+    partial_path = os.path.join(processed_folder, f"{name}.partial{ext}")
+    output_format = MUXERS.get(ext.lower(), ext[1:].lower() or None)
     
-    if os.path.exists(output_path):
-        print(f"Processed video {output_path} already exists, skipping...")
-        return (True, video_file, output_path, filename)  # Consider existing as success
-        
     print(f"Processing {filename}...")
-    success = resize_video(video_file, output_path)
+    if zip_source:
+        success = await transcode_video("pipe:0", partial_path, encoder, ffmpeg_threads, zip_source, output_format,
+                                        fallback_threads, device)
+    else:
+        success = await transcode_video(video_file, partial_path, encoder, ffmpeg_threads, None, output_format,
+                                        fallback_threads, device)
     
     if success:
-        print(f"Successfully processed {filename} -> {name}_480p{ext}")
-        # Remove original to save space
-        try:
-            os.remove(video_file)
-            print(f"Deleted original HD video: {filename}")
-        except OSError as e:
-            print(f"Warning: Could not delete {filename}: {e}")
+        os.replace(partial_path, output_path)
+        print(f"Successfully processed {filename} -> {output_filename}")
     else:
         print(f"Failed to process {filename}")
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
     
     return (success, video_file, output_path, filename)
 
 
+def _remove_original(video_file):
+    try:
+        os.remove(video_file)
+        print(f"Deleted original HD video: {os.path.basename(video_file)}")
+    except OSError as e:
+        print(f"Warning: Could not delete {video_file}: {e}")
+
+
+async def _run_videos(videos, processed_folder, encoder, num_processes, ffmpeg_threads, fallback_threads=None,
+                      num_gpus=1):
+    """
+    Run up to num_processes ffmpegs at a time from this one process, spread round-robin
+    over num_gpus GPUs. Originals that were extracted to disk are deleted by background
+    threads once they are processed.
+    Returns (output_paths, failed_videos) tuple
+    """
+    # One entry per ffmpeg allowed to run, each tied to a GPU so the sessions are spread evenly
+    slots = asyncio.Queue()
+    for slot in range(num_processes):
+        slots.put_nowait(slot % num_gpus)
+    loop = asyncio.get_running_loop()
+    deletions = []
+
+    async def run_one(video):
+        device = await slots.get()
+        try:
+            success, video_file, output_path, filename = await process_single_video(
+                video, processed_folder, encoder, ffmpeg_threads, fallback_threads, device
+            )
+        finally:
+            slots.put_nowait(device)
+        if success and not isinstance(video, tuple):
+            # Remove original to save space
+            deletions.append(loop.run_in_executor(None, _remove_original, video_file))
+        return success, video_file, output_path
+
+    results = await asyncio.gather(*(run_one(video) for video in videos))
+    await asyncio.gather(*deletions)
+
+    output_paths = [output_path for success, _, output_path in results if success]
+    failed_videos = [video_file for success, video_file, _ in results if not success]
+    return output_paths, failed_videos
+
+
+def process_videos(videos, processed_folder, num_processes=None):
+    """
+    Process videos (file paths or (zip_path, member) tuples) with up to num_processes
+    ffmpegs running in parallel.
+    Returns (output_paths, failed_videos) tuple, output_paths including videos processed by an earlier run
+    """
+    # Skip videos processed by an earlier run up front, so they don't count towards the parallelism
+    existing = set(os.listdir(processed_folder))
+    todo = []
+    done_paths = []
+    seen = set()
+    for video in videos:
+        video_file = video[1] if isinstance(video, tuple) else video
+        output_filename = processed_filename(video_file)
+        # Outputs are named after the basename, so zip members with the same name in different
+        # directories would write the same file and be archived twice
+        if output_filename in seen:
+            print(f"Warning: Skipping {video_file}, another video is already processed to {output_filename}")
+            continue
+        seen.add(output_filename)
+        if output_filename in existing:
+            done_paths.append(os.path.join(processed_folder, output_filename))
+        else:
+            todo.append(video)
+    if done_paths:
+        print(f"Skipping {len(done_paths)} videos that were already processed...")
+    if not todo:
+        return done_paths, []
+    
+    # Size the parallelism by the ffmpeg thread budget so processes x threads fits the CPU
+    encoder = detect_encoder()
+    num_processes, ffmpeg_threads = plan_workers(len(todo), encoder, num_processes)
+    # Videos the GPU can't encode are retried on the CPU, where the GPU path's single thread
+    # would crawl, so give them the libx264 budget for this many workers
+    _, fallback_threads = plan_workers(num_processes, "libx264", num_processes)
+    
+    print(f"Using {num_processes} processes with {ffmpeg_threads} ffmpeg threads each for video processing...")
+    
+    # ffmpeg does the work, so the subprocesses are driven from this process's event loop
+    output_paths, failed_videos = asyncio.run(
+        _run_videos(todo, processed_folder, encoder, num_processes, ffmpeg_threads, fallback_threads, count_gpus(encoder))
+    )
+    
+    print(f"Video processing complete: {len(output_paths)} successful, {len(failed_videos)} failed")
+    return done_paths + output_paths, failed_videos
+
+
 def process_videos_in_folder(video_folder, processed_folder, num_processes=None):
     """
-    Process all videos in the video folder using multiprocessing
+    Process all videos in the video folder in parallel
+    Returns the paths of the processed videos
     """
     os.makedirs(processed_folder, exist_ok=True)
     
-    # Get all video files (common extensions)
-    video_extensions = ['*.mp4', '*.avi', '*.mov', '*.mkv', '*.webm', '*.flv']
+    # Get all video files (common extensions) in a single directory pass
     video_files = []
-    for ext in video_extensions:
-        video_files.extend(glob.glob(os.path.join(video_folder, ext)))
+    if os.path.isdir(video_folder):
+        with os.scandir(video_folder) as entries:
+            video_files = [
+                entry.path for entry in entries
+                if entry.is_file() and os.path.splitext(entry.name)[1].lower() in VIDEO_EXTENSIONS
+            ]
     
     if not video_files:
         print("No videos found to process.")
-        return
+        return []
     
     print(f"Found {len(video_files)} videos to process...")
+    output_paths, _ = process_videos(video_files, processed_folder, num_processes)
+    return output_paths
+
+
+def list_zip_videos(zip_path):
+    """
+    List the video members of a zip without extracting it
+    """
+    result = subprocess.run(["unzip", "-Z1", zip_path], check=True, capture_output=True, text=True)
+    return [member for member in result.stdout.splitlines() if member.lower().endswith(VIDEO_EXTENSIONS)]
+
+
+def process_videos_in_zip(zip_path, members, processed_folder, staging_folder, num_processes=None):
+    """
+    Process videos straight out of a zip by piping each member from unzip -p into ffmpeg,
+    so the HD originals are never written to disk. Members ffmpeg can't read from a pipe
+    (mp4s without faststart) are extracted to staging_folder and processed from there.
+    Returns the paths of the processed videos
+    """
+    os.makedirs(processed_folder, exist_ok=True)
     
-    # Determine number of processes
-    if num_processes is None:
-        num_processes = min(mp.cpu_count(), len(video_files), 64)  # Cap at 64 to avoid overwhelming system
-    
-    print(f"Using {num_processes} processes for video processing...")
-    
-    # Prepare arguments for each worker
-    worker_args = [(video_file, processed_folder) for video_file in video_files]
-    
-    # Process videos in parallel
-    with mp.Pool(processes=num_processes) as pool:
-        # Use imap_unordered for better memory efficiency and progress updates
-        results = pool.imap_unordered(process_single_video, worker_args)
-        
-        # Process results as they complete
-        successful = 0
-        failed = 0
-        for success, video_file, output_path, filename in results:
-            if success:
-                successful += 1
-            else:
-                failed += 1
+    if not members:
+        print("No videos found to process.")
+        return []
     
-    print(f"Video processing complete: {successful} successful, {failed} failed")
+    print(f"Found {len(members)} videos to process...")
+    output_paths, failed_members = process_videos([(zip_path, member) for member in members], processed_folder, num_processes)
+    if not failed_members:
+        return output_paths
 
+    print(f"Extracting {len(failed_members)} videos that couldn't be streamed...")
+    unzip_command = ["unzip", "-j", "-o", zip_path, *map(unzip_pattern, failed_members), "-d", staging_folder]
+    try:
+        subprocess.run(unzip_command, check=True)
+    except subprocess.CalledProcessError as unzip_e:
+        print(f"Failed to extract videos from {zip_path}: {unzip_e}")
+        return output_paths
+    return output_paths + process_videos_in_folder(staging_folder, processed_folder, num_processes)
 
-def zip_and_upload_to_s3(processed_folder, part_number):
+
+class S3MultipartWriter:
+    """
+    Write-only file object that sends everything written to it to S3 as a multipart upload,
+    so an archive can be streamed to S3 without being written to local disk first
+    """
+
+    def __init__(self, client, bucket, key, part_size=S3_PART_SIZE, max_in_flight=S3_MAX_IN_FLIGHT_PARTS):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+        self.buffer = bytearray()
+        self.futures = []
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        # Block writers once max_in_flight parts are waiting, to bound memory use
+        self.slots = threading.Semaphore(max_in_flight)
+        # First failed part, re-raised by the next write so a failed upload stops the archive early
+        self.error = None
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._submit_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _part_done(self, future):
+        if self.error is None and not future.cancelled() and future.exception() is not None:
+            self.error = future.exception()
+        self.slots.release()
+
+    def _submit_part(self, body):
+        self.slots.acquire()
+        if self.error is not None:
+            self.slots.release()
+            raise self.error
+        part_number = len(self.futures) + 1
+        future = self.executor.submit(self._upload_part, part_number, body)
+        future.add_done_callback(self._part_done)
+        self.futures.append(future)
+
+    def _upload_part(self, part_number, body):
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=body
+        )
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    def close(self):
+        """
+        Upload the remaining buffered bytes and complete the multipart upload
+        """
+        if self.buffer or not self.futures:
+            self._submit_part(bytes(self.buffer))
+            self.buffer.clear()
+        parts = [future.result() for future in self.futures]
+        self.executor.shutdown()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={"Parts": parts}
+        )
+
+    def abort(self):
+        """
+        Cancel the multipart upload so S3 discards the parts uploaded so far
+        """
+        self.executor.shutdown(cancel_futures=True)
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+def add_file_to_zip(zip_file, path, arcname):
+    """
+    Copy a file into an open zip with large sequential reads, then drop it from the page
+    cache since it is deleted right after the upload and would only evict useful pages
+    """
+    zip_info = zipfile.ZipInfo.from_file(path, arcname)
+    with open(path, "rb") as src, zip_file.open(zip_info, "w") as dest:
+        fadvise = getattr(os, "posix_fadvise", None)
+        if fadvise:
+            fadvise(src.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        shutil.copyfileobj(src, dest, COPY_BUFFER_SIZE)
+        if fadvise:
+            fadvise(src.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def zip_and_upload_to_s3(output_paths, part_number, cleanup_q=None):
     """
-    Zip the processed folder and upload to S3
+    Zip a part's processed videos straight into an S3 multipart upload, without a local
+    zip file, then delete them (through cleanup_q if given)
     Returns True if successful, False otherwise
     """
-    if not os.path.exists(processed_folder) or not os.listdir(processed_folder):
-        print(f"Processed folder {processed_folder} is empty or doesn't exist, skipping zip/upload")
+    if not output_paths:
+        print(f"No processed videos for part {part_number}, skipping zip/upload")
         return False
     
     # Create zip file name
     zip_filename = f"video_480p_part_{part_number}.zip"
-    zip_path = os.path.join(os.path.dirname(processed_folder), zip_filename)
+    s3_key = f"{S3_PREFIX}/{zip_filename}"
+    s3_path = f"s3://{S3_BUCKET}/{s3_key}"
     
     try:
-        # Create zip file
-        print(f"Creating zip file: {zip_filename}")
-        shutil.make_archive(zip_path[:-4], 'zip', processed_folder)  # Remove .zip extension as make_archive adds it
-        
-        if not os.path.exists(zip_path):
-            print(f"Error: Zip file {zip_path} was not created")
-            return False
-        
-        # Upload to S3
-        s3_path = f"s3://{S3_BUCKET}/kelkar/dataset/{zip_filename}"
-        upload_command = ["aws", "s3", "cp", zip_path, s3_path]
-        
-        print(f"Uploading {zip_filename} to S3...")
-        result = subprocess.run(upload_command, check=True, capture_output=True, text=True)
+        print(f"Zipping and uploading {zip_filename} to S3...")
+        writer = S3MultipartWriter(boto3.client("s3"), S3_BUCKET, s3_key)
+        try:
+            # The videos are already compressed, so store them instead of deflating
+            with zipfile.ZipFile(writer, "w", zipfile.ZIP_STORED) as zip_file:
+                for output_path in sorted(output_paths):
+                    add_file_to_zip(zip_file, output_path, os.path.basename(output_path))
+            writer.close()
+        except BaseException:
+            writer.abort()
+            raise
         print(f"Successfully uploaded {zip_filename} to {s3_path}")
         
-        # Clean up: remove the zip file and processed folder to save space
-        try:
-            os.remove(zip_path)
-            print(f"Deleted local zip file: {zip_path}")
-            
-            shutil.rmtree(processed_folder)
-            print(f"Deleted processed folder: {processed_folder}")
-        except OSError as e:
-            print(f"Warning: Could not clean up files: {e}")
+        # Clean up: remove the uploaded videos to save space
+        if cleanup_q is not None:
+            for output_path in output_paths:
+                cleanup_q.put(output_path)
+        else:
+            for output_path in output_paths:
+                try:
+                    os.remove(output_path)
+                except OSError as e:
+                    print(f"Warning: Could not delete {output_path}: {e}")
+            print(f"Deleted {len(output_paths)} uploaded videos of part {part_number}")
         
         return True
         
-    except subprocess.CalledProcessError as e:
-        print(f"Error uploading {zip_filename} to S3:")
-        print(f"Command: {' '.join(upload_command)}")
-        print(f"Return code: {e.returncode}")
-        if e.stdout:
-            print(f"STDOUT: {e.stdout}")
-        if e.stderr:
-            print(f"STDERR: {e.stderr}")
+    except (BotoCoreError, ClientError) as e:
+        print(f"Error uploading {zip_filename} to S3: {e}")
         return False
     except Exception as e:
         print(f"Error creating zip or uploading {zip_filename}: {e}")
         return False
 
 
-def download_files(output_directory, num_processes=None):
+def _put(q, item, stop_event):
+    """
+    Put an item on a bounded queue, giving up if the pipeline is shutting down.
+    Returns True if the item was queued
+    """
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _acquire(semaphore, stop_event):
+    """
+    Acquire a semaphore, giving up if the pipeline is shutting down.
+    Returns True if it was acquired
+    """
+    while not stop_event.is_set():
+        if semaphore.acquire(timeout=1):
+            return True
+    return False
+
+
+def _get(q, stop_event):
+    """
+    Get an item from a queue, returning None if the pipeline is shutting down
+    """
+    while not stop_event.is_set():
+        try:
+            return q.get(timeout=1)
+        except queue.Empty:
+            continue
+    return None
+
+
+def default_interface():
+    """
+    Name of the network interface holding the default route, or None if there isn't one
+    """
+    try:
+        with open("/proc/net/route") as route_file:
+            for line in route_file.readlines()[1:]:
+                fields = line.split()
+                if len(fields) > 1 and fields[1] == "00000000":
+                    return fields[0]
+    except OSError:
+        pass
+    return None
+
+
+def tune_network():
+    """
+    Raise socket buffer limits, grow the NIC rings and spread NIC IRQs over cores so
+    downloads can reach line rate. These are system-wide settings that need root,
+    so a failing step only prints a warning.
+    """
+    commands = [["sysctl", "-w", f"{key}={value}"] for key, value in NETWORK_SYSCTLS.items()]
+    interface = default_interface()
+    if interface is not None:
+        commands.append(["ethtool", "-G", interface, "rx", NIC_RING_SIZE, "tx", NIC_RING_SIZE])
+        # Ships with the Mellanox/Intel driver tools, pins each NIC queue's IRQ to its own core
+        if shutil.which("set_irq_affinity.sh"):
+            commands.append(["set_irq_affinity.sh", interface])
+
+    for command in commands:
+        try:
+            subprocess.run(command, check=True, capture_output=True, text=True)
+            print(f"Network tuning: {' '.join(command)}")
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"Warning: Network tuning step {' '.join(command)} failed: {e}")
+
+
+def build_download_command(url, file_path, resume=False):
+    """
+    Build an aria2c command that downloads url to file_path over 16 parallel connections.
+    With resume, an existing partial file is continued instead of downloaded again.
+    """
+    if resume:
+        existing_file = "--continue=true"
+    else:
+        existing_file = "--allow-overwrite=true"   # Match wget -O semantics
+    return [
+        "aria2c",
+        "--max-connection-per-server=16",   # Parallel connections to the server
+        "--split=16",                       # Parallel ranges per file
+        "--min-split-size=1M",              # Smallest range worth splitting off
+        "--file-allocation=none",           # Don't preallocate multi-GB files
+        "--max-tries=5",
+        "--retry-wait=2",
+        f"--socket-recv-buffer-size={ARIA2_SOCKET_RECV_BUFFER}",
+        existing_file,
+        "--auto-file-renaming=false",
+        "-d", os.path.dirname(file_path),
+        "-o", os.path.basename(file_path),
+        url
+    ]
+
+
+class _HeadRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """
+    Keep HEAD requests as HEAD when following redirects, urllib turns them into GETs
+    """
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        new_req = super().redirect_request(req, fp, code, msg, headers, newurl)
+        if new_req is not None:
+            new_req.method = req.get_method()
+        return new_req
+
+
+def remote_size(url):
+    """
+    Content-Length of url from a HEAD request, or None if it can't be determined
+    """
+    opener = urllib.request.build_opener(_HeadRedirectHandler)
+    try:
+        with opener.open(urllib.request.Request(url, method="HEAD"), timeout=30) as response:
+            return int(response.headers["Content-Length"])
+    except (OSError, TypeError, ValueError):
+        return None
+
+
+def download_file(url, file_path):
+    """
+    Download url to file_path. A complete local copy (same size as the remote file) is kept,
+    a partial one is resumed, and one larger than the remote file is downloaded again.
+    Raises CalledProcessError if the download fails
+    """
+    resume = False
+    if os.path.exists(file_path):
+        size = remote_size(url)
+        local_size = os.path.getsize(file_path)
+        # Without preallocation aria2c files can reach full size before they are complete,
+        # its control file is what tells an interrupted download apart
+        interrupted = os.path.exists(file_path + ".aria2")
+        if size is not None and local_size == size and not interrupted:
+            print(f"file {file_path} already downloaded, skipping.")
+            return
+        if size is not None and local_size > size and not interrupted:
+            print(f"file {file_path} is larger than {url}, downloading it again.")
+            os.remove(file_path)
+        else:
+            print(f"Resuming download of {file_path}...")
+            resume = True
+
+    subprocess.run(build_download_command(url, file_path, resume), check=True)
+
+
+def _log_error(error_log_path, error_message):
+    print(error_message)
+    with open(error_log_path, "a") as error_log_file:
+        error_log_file.write(error_message)
+
+
+def download_part(i, zip_folder, error_log_path):
+    """
+    Download part i, falling back to the split _part_aa/_part_ab files for parts that aren't
+    published as a single zip. Downloads that were interrupted by an earlier run are resumed.
+    Returns (file_path, downloaded_paths) tuple, or None if the part couldn't be downloaded
+    """
+    url = f"{HF_URL}/OpenVidHD/OpenVidHD_part_{i}.zip"
+    file_path = os.path.join(zip_folder, f"OpenVidHD_part_{i}.zip")
+
+    try:
+        download_file(url, file_path)
+        print(f"file {url} saved to {file_path}")
+        return (file_path, [file_path])
+    except subprocess.CalledProcessError as e:
+        _log_error(error_log_path, f"file {url} download failed: {e}\n")
+    if remote_size(url) is not None:
+        # The zip exists, so this was a transient failure: keep the partial zip and
+        # its control file for the next run to resume
+        return None
+
+    part_urls = [
+        f"{HF_URL}/OpenVidHD/OpenVidHD_part_{i}_part_aa",
+        f"{HF_URL}/OpenVidHD/OpenVidHD_part_{i}_part_ab"
+    ]
+
+    part_files = []
+    for part_url in part_urls:
+        part_file_path = os.path.join(zip_folder, os.path.basename(part_url))
+        try:
+            download_file(part_url, part_file_path)
+            print(f"file {part_url} saved to {part_file_path}")
+        except subprocess.CalledProcessError as part_e:
+            _log_error(error_log_path, f"file {part_url} download failed: {part_e}\n")
+            # Without every split file the zip would be truncated, keep what was
+            # downloaded for the next run to resume
+            return None
+        part_files.append(part_file_path)
+    # The first split file becomes the zip and the others are appended and deleted one by
+    # one, so a split part takes little more disk than a single zip
+    os.replace(part_files[0], file_path)
+    with open(file_path, "ab") as zip_file:
+        for part_file_path in part_files[1:]:
+            with open(part_file_path, "rb") as part_file:
+                shutil.copyfileobj(part_file, zip_file, COPY_BUFFER_SIZE)
+            os.remove(part_file_path)
+    return (file_path, [file_path])
+
+
+def download_stage(zip_folder, error_log_path, unzip_q, parts_on_disk, stop_event):
+    """
+    Pipeline stage 1: download each part and hand the zip to the unzip stage.
+    Each download waits for a parts_on_disk slot, which the cleaner releases once its zip is deleted.
+    """
+    try:
+        for i in PARTS:
+            if not _acquire(parts_on_disk, stop_event):
+                break
+            downloaded = download_part(i, zip_folder, error_log_path)
+            if downloaded is None:
+                print(f"Skipping part {i}, its download is resumed on the next run")
+                parts_on_disk.release()
+                continue
+            file_path, downloaded_paths = downloaded
+            _put(unzip_q, (i, file_path, downloaded_paths), stop_event)
+    except Exception:
+        stop_event.set()
+        raise
+    finally:
+        _put(unzip_q, None, stop_event)
+
+
+def unzip_stage(unzip_q, encode_q, cleanup_q, parts_on_disk, stop_event):
+    """
+    Pipeline stage 2: read each part's zip directory so the encoders can stream its videos
+    """
+    try:
+        while (item := _get(unzip_q, stop_event)) is not None:
+            i, file_path, downloaded_paths = item
+            try:
+                members = list_zip_videos(file_path)
+            except subprocess.CalledProcessError as unzip_e:
+                # An unreadable zip is complete as far as aria2c knows, so it would be read again
+                # on every run. Delete it so the next run downloads it again
+                print(f"Failed to read zip file for part {i}, deleting it: {unzip_e}")
+                cleanup_q.put((downloaded_paths, parts_on_disk.release))
+                continue
+            _put(encode_q, (i, file_path, members, downloaded_paths), stop_event)
+    except Exception:
+        stop_event.set()
+        raise
+    finally:
+        _put(encode_q, None, stop_event)
+
+
+def upload_stage(upload_q, cleanup_q, stop_event):
+    """
+    Pipeline stage 4: zip and upload each processed part, then queue its videos for deletion
+    """
+    try:
+        while (item := _get(upload_q, stop_event)) is not None:
+            i, output_paths = item
+            print(f"Zipping and uploading part {i} to S3...")
+            zip_and_upload_to_s3(output_paths, i, cleanup_q)
+    except Exception:
+        stop_event.set()
+        raise
+
+
+def cleanup_stage(cleanup_q):
+    """
+    Background cleaner: delete each path put on cleanup_q until it receives None, so
+    slow unlinks of multi-GB files never hold up the next upload. An item can also be a
+    (paths, on_deleted) tuple, on_deleted is then called once all of paths are deleted.
+    """
+    for item in iter(cleanup_q.get, None):
+        paths, on_deleted = item if isinstance(item, tuple) else ([item], None)
+        for path in paths:
+            try:
+                os.remove(path)
+                print(f"Deleted file: {path}")
+            except OSError as e:
+                print(f"Warning: Could not delete file {path}: {e}")
+        if on_deleted is not None:
+            on_deleted()
+
+
+def download_files(output_directory, num_processes=None, network_tuning=False):
+    """
+    Download, extract, resize and upload every part. The stages run as a pipeline
+    connected by bounded queues, so the network, disk and encoders are busy at the
+    same time. At most MAX_PARTS_ON_DISK HD zips are on disk at once: each is deleted as
+    soon as its part is encoded, since the upload only needs the 480p outputs.
+    """
+    if network_tuning:
+        tune_network()
+
     zip_folder = os.path.join(output_directory, "download")
     video_folder = os.path.join(output_directory, "video")
+    # Shared by every part, each part uploads only the videos it produced
+    processed_folder = os.path.join(output_directory, "video_480p")
     os.makedirs(zip_folder, exist_ok=True)
     os.makedirs(video_folder, exist_ok=True)
 
     error_log_path = os.path.join(zip_folder, "download_log.txt")
 
-    for i in range(1, 100):
-        # Create separate folder for each part's processed videos
-        processed_folder = os.path.join(output_directory, f"video_480p_part_{i}")
-        os.makedirs(processed_folder, exist_ok=True)
-        
-        url = f"https://huggingface.co/datasets/nkp37/OpenVid-1M/resolve/main/OpenVidHD/OpenVidHD_part_{i}.zip"
-        file_path = os.path.join(zip_folder, f"OpenVidHD_part_{i}.zip")
-        if os.path.exists(file_path):
-            print(f"file {file_path} exits.")
-            continue
+    unzip_q = queue.Queue(maxsize=QUEUE_SIZE)
+    encode_q = queue.Queue(maxsize=QUEUE_SIZE)
+    upload_q = queue.Queue(maxsize=QUEUE_SIZE)
+    # Unbounded, queueing a deletion must never block
+    cleanup_q = queue.Queue()
+    parts_on_disk = threading.Semaphore(MAX_PARTS_ON_DISK)
+    stop_event = threading.Event()
 
-        command = ["wget", "-O", file_path, url]
-        unzip_command = ["unzip", "-j", file_path, "-d", video_folder]
-        try:
-            subprocess.run(command, check=True)
-            print(f"file {url} saved to {file_path}")
-            subprocess.run(unzip_command, check=True)
-            
-            # Process videos after each successful extraction
-            print(f"Processing videos from part {i}...")
-            process_videos_in_folder(video_folder, processed_folder, num_processes)
-            
-            # Zip processed folder and upload to S3
-            print(f"Zipping and uploading part {i} to S3...")
-            success = zip_and_upload_to_s3(processed_folder, i)
+    # Deletions run on their own thread so no pipeline stage waits on them
+    cleaner = threading.Thread(target=cleanup_stage, args=(cleanup_q,), daemon=True)
+    cleaner.start()
 
-            if success:
-                print(f"Cleaning up original downloaded files for part {i}...")
-                try:
-                    os.remove(file_path)
-                    print(f"Deleted original downloaded zip: {file_path}")
-                except OSError as e:
-                    print(f"Warning: Could not delete original zip {file_path}: {e}")
-            
-        except subprocess.CalledProcessError as e:
-            error_message = f"file {url} download failed: {e}\n"
-            print(error_message)
-            with open(error_log_path, "a") as error_log_file:
-                error_log_file.write(error_message)
-            
-            part_urls = [
-                f"https://huggingface.co/datasets/nkp37/OpenVid-1M/resolve/main/OpenVidHD/OpenVidHD_part_{i}_part_aa",
-                f"https://huggingface.co/datasets/nkp37/OpenVid-1M/resolve/main/OpenVidHD/OpenVidHD_part_{i}_part_ab"
+    try:
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            stages = [
+                executor.submit(download_stage, zip_folder, error_log_path, unzip_q, parts_on_disk, stop_event),
+                executor.submit(unzip_stage, unzip_q, encode_q, cleanup_q, parts_on_disk, stop_event),
+                executor.submit(upload_stage, upload_q, cleanup_q, stop_event),
             ]
 
-            for part_url in part_urls:
-                part_file_path = os.path.join(zip_folder, os.path.basename(part_url))
-                if os.path.exists(part_file_path):
-                    print(f"file {part_file_path} exits.")
-                    continue
-
-                part_command = ["wget", "-O", part_file_path, part_url]
-                try:
-                    subprocess.run(part_command, check=True)
-                    print(f"file {part_url} saved to {part_file_path}")
-                except subprocess.CalledProcessError as part_e:
-                    part_error_message = f"file {part_url} download failed: {part_e}\n"
-                    print(part_error_message)
-                    with open(error_log_path, "a") as error_log_file:
-                        error_log_file.write(part_error_message)
-            file_path = os.path.join(zip_folder, f"OpenVidHD_part_{i}.zip")
-            cat_command = "cat " + os.path.join(zip_folder, f"OpenVidHD_part_{i}_part*") + " > " + file_path
-            unzip_command = ["unzip", "-j", file_path, "-d", video_folder]
-            os.system(cat_command)
+            # Pipeline stage 3: encode in the main thread, which drives the ffmpeg subprocesses
             try:
-                subprocess.run(unzip_command, check=True)
-                # Process videos after successful extraction from concatenated parts
-                print(f"Processing videos from part {i} (concatenated)...")
-                process_videos_in_folder(video_folder, processed_folder, num_processes)
-                
-                # Zip processed folder and upload to S3
-                print(f"Zipping and uploading part {i} (concatenated) to S3...")
-                success = zip_and_upload_to_s3(processed_folder, i)
-
-                if success:
-                    print(f"Cleaning up original downloaded files for part {i}...")
+                while (item := _get(encode_q, stop_event)) is not None:
+                    i, file_path, members, downloaded_paths = item
+                    part_video_folder = os.path.join(video_folder, f"part_{i}")
+                    print(f"Processing videos from part {i}...")
+                    output_paths = process_videos_in_zip(file_path, members, processed_folder, part_video_folder, num_processes)
                     try:
-                        # Delete concatenated file
-                        os.remove(file_path)
-                        print(f"Deleted concatenated zip: {file_path}")
-
-                        # Delete parts
-                        part_files_pattern = os.path.join(zip_folder, f"OpenVidHD_part_{i}_part_*")
-                        part_files = glob.glob(part_files_pattern)
-                        for part_file in part_files:
-                            os.remove(part_file)
-                            print(f"Deleted part file: {part_file}")
-
-                    except OSError as e:
-                        print(f"Warning: Could not delete original downloaded files for part {i}: {e}")
-            except subprocess.CalledProcessError as unzip_e:
-                print(f"Failed to unzip concatenated file for part {i}: {unzip_e}")
-    
+                        os.rmdir(part_video_folder)
+                    except OSError:
+                        # Videos that failed to process are left in place
+                        pass
+
+                    # The 480p outputs are on disk, so the HD zip can go before the upload.
+                    # Its slot is only released once the cleaner has unlinked it
+                    print(f"Cleaning up original downloaded files for part {i}...")
+                    cleanup_q.put((downloaded_paths, parts_on_disk.release))
+                    _put(upload_q, (i, output_paths), stop_event)
+            except BaseException:
+                stop_event.set()
+                raise
+            finally:
+                _put(upload_q, None, stop_event)
+
+            for stage in stages:
+                stage.result()
+    finally:
+        # Let queued deletions finish before returning
+        cleanup_q.put(None)
+        cleaner.join()
+
     data_folder = os.path.join(output_directory, "data", "train")
     os.makedirs(data_folder, exist_ok=True)
     data_urls = [
-        "https://huggingface.co/datasets/nkp37/OpenVid-1M/resolve/main/data/train/OpenVidHD.csv"
+        f"{HF_URL}/data/train/OpenVidHD.csv"
     ]
     for data_url in data_urls:
         data_path = os.path.join(data_folder, os.path.basename(data_url))
-        command = ["wget", "-O", data_path, data_url]
-        subprocess.run(command, check=True)
+        download_file(data_url, data_path)
 
     # delete zip files
     # delete_command = "rm -rf " + zip_folder
@@ -290,15 +1127,9 @@ def download_files(output_directory, num_processes=None):
 
 
 if __name__ == '__main__':
-    # Required for multiprocessing on Windows and some other platforms
-    try:
-        mp.set_start_method('spawn', force=True)
-    except RuntimeError:
-        # Start method already set, continue
-        pass
-    
     parser = argparse.ArgumentParser(description='Process some parameters.')
     parser.add_argument('--output_directory', type=str, help='Path to the dataset directory', default="/path/to/dataset")
     parser.add_argument('--num_processes', type=int, help='Number of processes for video processing', default=None)
+    parser.add_argument('--tune_network', action='store_true', help='Tune kernel and NIC settings for fast downloads (system-wide, needs root)')
     args = parser.parse_args()
-    download_files(args.output_directory, args.num_processes)
+    download_files(args.output_directory, args.num_processes, args.tune_network)